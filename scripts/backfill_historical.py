@@ -4,9 +4,10 @@ import logging
 from datetime import datetime
 
 # Reuse extract_data logic
-from extract_data import main, logger
+from extract_data import main, logger, setup_logging
 
 if __name__ == "__main__":
+    setup_logging()
     logger.info("Running historical backfill...")
     logger.info("This will fetch 60 days of data from Databricks")
 
@@ -1,17 +1,22 @@
 """Configuration for Databricks connection and queries."""
 import os
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta, timezone
 
 # Databricks connection
 DATABRICKS_SERVER_HOSTNAME = "adb-1825183661408911.11.azuredatabricks.net"
 DATABRICKS_HTTP_PATH = "sql/protocolv1/o/1825183661408911/0523-172047-4vu5f6v7"
 DATABRICKS_TOKEN = os.environ.get("DATABRICKS_TOKEN", "")
 
+# Native :name query parameters need DBR 14.1+ on the cluster behind
+# DATABRICKS_HTTP_PATH; set DATABRICKS_INLINE_PARAMS=1 for older runtimes
+DATABRICKS_INLINE_PARAMS = os.environ.get("DATABRICKS_INLINE_PARAMS", "") == "1"
+
 # Data settings
 COUNTRIES = ["PH", "VN"]
 HISTORY_DAYS = 60
 MOVING_AVERAGE_WINDOWS = [7, 30]
+FETCH_BATCH_SIZE = 65536  # Rows per Arrow batch when streaming query results
+QUERY_WORKERS = 3  # Query threads shared by all countries, one Databricks session each
 
 # Currency conversion rates to USD
 CURRENCY_RATES = {
@@ -19,70 +24,65 @@ CURRENCY_RATES = {
     "VN": 26416,   # VND to USD
 }
 
+# Reciprocal rates, so conversions multiply instead of divide
+CURRENCY_RECIP = {country: 1 / rate for country, rate in CURRENCY_RATES.items()}
+
+# UTC offsets in hours, used for timezones and local-date filters in queries
+TZ_OFFSETS = {
+    "PH": 8,
+    "VN": 7,
+    "HK": 8,
+}
+
 # Timezone settings
+# None of these zones observe DST, so fixed offsets are exact and avoid the
+# slower ZoneInfo lookups. Switch to ZoneInfo for any future DST country.
 TIMEZONES = {
-    "PH": ZoneInfo("Asia/Manila"),      # UTC+8
-    "VN": ZoneInfo("Asia/Ho_Chi_Minh"), # UTC+7
-    "HK": ZoneInfo("Asia/Hong_Kong"),   # UTC+8 (for display)
+    "PH": timezone(timedelta(hours=TZ_OFFSETS["PH"]), "Asia/Manila"),       # UTC+8
+    "VN": timezone(timedelta(hours=TZ_OFFSETS["VN"]), "Asia/Ho_Chi_Minh"),  # UTC+7
+    "HK": timezone(timedelta(hours=TZ_OFFSETS["HK"]), "Asia/Hong_Kong"),    # UTC+8 (for display)
 }
 
 # File paths (relative to repository root)
 DATA_DIR = "../data"
 LOGS_DIR = "../logs"
 
-def get_today():
-    """Get today's date in Hong Kong timezone."""
-    hk_now = datetime.now(TIMEZONES["HK"])
-    return hk_now.date()
+# Parquet cache of raw order rows, partitioned by country and local date.
+# Days older than RAW_CACHE_SETTLE_DAYS are treated as final and read from
+# the cache instead of Databricks.
+RAW_CACHE_DIR = "../.cache/raw"
+RAW_CACHE_SETTLE_DAYS = 2
 
-def get_same_day_last_week():
-    """Get date for same day last week in Hong Kong timezone."""
-    return get_today() - timedelta(days=7)
+def hk_now():
+    """Get the current datetime in Hong Kong timezone."""
+    return datetime.now(TIMEZONES["HK"])
+
+def same_day_last_week_of(today):
+    """Get date for same day last week relative to today."""
+    return today - timedelta(days=7)
 
-def get_mtd_start():
-    """Get first day of current month in Hong Kong timezone."""
-    hk_now = datetime.now(TIMEZONES["HK"])
-    return datetime(hk_now.year, hk_now.month, 1, tzinfo=TIMEZONES["HK"]).date()
+def mtd_start_of(today):
+    """Get first day of today's month."""
+    return today.replace(day=1)
 
-def get_last_month_mtd_range():
+def last_month_mtd_range_of(today):
     """
-    Get same MTD date range from last month.
+    Get same MTD date range from last month, relative to today.
     Example: If today is Jan 27, returns (Dec 1, Dec 27)
+    If the day doesn't exist in last month (e.g. Mar 31), the range ends on
+    the last day of last month (Feb 28/29).
     """
-    hk_now = datetime.now(TIMEZONES["HK"])
-    today = hk_now.date()
-    day_of_month = today.day
-
-    # Get first day of last month
-    if hk_now.month == 1:
-        last_month_start = datetime(hk_now.year - 1, 12, 1, tzinfo=TIMEZONES["HK"]).date()
-    else:
-        last_month_start = datetime(hk_now.year, hk_now.month - 1, 1, tzinfo=TIMEZONES["HK"]).date()
-
-    # Get same day of last month (or last day if day doesn't exist)
-    try:
-        if hk_now.month == 1:
-            last_month_end = datetime(hk_now.year - 1, 12, day_of_month, tzinfo=TIMEZONES["HK"]).date()
-        else:
-            last_month_end = datetime(hk_now.year, hk_now.month - 1, day_of_month, tzinfo=TIMEZONES["HK"]).date()
-    except ValueError:
-        # Day doesn't exist in last month (e.g., Jan 31 -> Feb 28/29)
-        # Use last day of last month
-        if hk_now.month == 1:
-            last_month_end = datetime(hk_now.year - 1, 12, 31, tzinfo=TIMEZONES["HK"]).date()
-        else:
-            # Get last day of previous month
-            first_of_this_month = datetime(hk_now.year, hk_now.month, 1, tzinfo=TIMEZONES["HK"])
-            last_month_end = (first_of_this_month - timedelta(days=1)).date()
+    last_day_of_last_month = mtd_start_of(today) - timedelta(days=1)
+
+    last_month_start = last_day_of_last_month.replace(day=1)
+    last_month_end = last_day_of_last_month.replace(day=min(today.day, last_day_of_last_month.day))
 
     return last_month_start, last_month_end
 
 def get_hk_time():
     """Get current time in Hong Kong timezone for display."""
-    return datetime.now(TIMEZONES["HK"])
+    return hk_now()
 
 def get_hk_now_utc():
     """Get current Hong Kong time as UTC for database queries."""
-    hk_now = datetime.now(TIMEZONES["HK"])
-    # Convert to UTC for database queries
-    return hk_now.astimezone(ZoneInfo("UTC"))
+    return hk_now().astimezone(timezone.utc)
@@ -1,167 +1,726 @@
 """Extract sales data from Databricks and generate JSON files."""
+import os
+import re
 import sys
-import json
+import time
+import random
+import shutil
+import atexit
+import argparse
 import logging
-from datetime import datetime, timedelta, timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from zoneinfo import ZoneInfo
 
 from databricks import sql
+from databricks.sql.exc import OperationalError
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
 
 from config import (
     DATABRICKS_SERVER_HOSTNAME,
     DATABRICKS_HTTP_PATH,
     DATABRICKS_TOKEN,
+    DATABRICKS_INLINE_PARAMS,
     COUNTRIES,
-    CURRENCY_RATES,
+    CURRENCY_RECIP,
+    FETCH_BATCH_SIZE,
+    QUERY_WORKERS,
     TIMEZONES,
+    TZ_OFFSETS,
     DATA_DIR,
     LOGS_DIR,
-    get_today,
-    get_same_day_last_week,
-    get_mtd_start,
-    get_last_month_mtd_range,
+    RAW_CACHE_DIR,
+    RAW_CACHE_SETTLE_DAYS,
+    hk_now,
+    same_day_last_week_of,
+    mtd_start_of,
+    last_month_mtd_range_of,
     get_hk_time,
     get_hk_now_utc,
 )
 
-# Setup logging
-Path(LOGS_DIR).mkdir(exist_ok=True)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(f"{LOGS_DIR}/extract_{datetime.now().strftime('%Y%m%d')}.log"),
-        logging.StreamHandler(sys.stdout),
-    ],
-)
-logger = logging.getLogger(__name__)
-
-
-def connect_to_databricks(max_retries=3, retry_delay_seconds=[0, 10, 20]):
+class CachedTimeFormatter(logging.Formatter):
     """
-    Connect to Databricks with retry logic.
+    Log formatter that renders the timestamp at most once per second.
 
-    Attempts connection 3 times within 30 seconds:
-    - Attempt 1: Immediate
-    - Attempt 2: After 10 seconds
-    - Attempt 3: After 20 seconds (total 30s window)
+    Output matches the default %(asctime)s format (YYYY-MM-DD HH:MM:SS,mmm);
+    only the strftime call is cached between records in the same second.
     """
-    import time
 
-    for attempt in range(max_retries):
-        try:
-            if attempt > 0:
-                time.sleep(retry_delay_seconds[attempt])
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_time = (None, "")
 
-            logger.info(f"Connecting to Databricks (attempt {attempt + 1}/{max_retries})...")
-            connection = sql.connect(
-                server_hostname=DATABRICKS_SERVER_HOSTNAME,
-                http_path=DATABRICKS_HTTP_PATH,
-                access_token=DATABRICKS_TOKEN,
-            )
-            logger.info("Successfully connected to Databricks")
-            return connection
-        except Exception as e:
-            logger.error(f"Connection attempt {attempt + 1} failed: {e}")
-            if attempt == max_retries - 1:
-                logger.error("All connection attempts failed")
-                raise
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
 
-    return None
+        second = int(record.created)
+        cached_second, cached_text = self._cached_time
+        if second != cached_second:
+            cached_text = time.strftime(self.default_time_format, self.converter(record.created))
+            self._cached_time = (second, cached_text)
 
+        return self.default_msec_format % (cached_text, record.msecs)
 
-def query_orders(connection, country, start_date, end_date, hour_limit=None):
+
+def setup_logging():
     """
-    Query orders from Databricks silver layer for a specific country and date range.
+    Log to stdout and to a dated file in LOGS_DIR.
 
-    Args:
-        connection: Databricks connection
-        country: Country code (PH or VN)
-        start_date: Start date (inclusive)
-        end_date: End date (inclusive)
-        hour_limit: Optional hour limit (0-23) for same-time comparisons
+    Called by the entry points, so importing this module for reuse doesn't
+    create the logs directory or touch the root logger.
+    """
+    Path(LOGS_DIR).mkdir(exist_ok=True)
+    log_formatter = CachedTimeFormatter("%(asctime)s - %(levelname)s - %(message)s")
+    log_handlers = [
+        # Open the log file lazily, on the first record written
+        logging.FileHandler(f"{LOGS_DIR}/extract_{datetime.now().strftime('%Y%m%d')}.log", delay=True),
+        logging.StreamHandler(sys.stdout),
+    ]
+    for log_handler in log_handlers:
+        log_handler.setFormatter(log_formatter)
+    logging.basicConfig(level=logging.INFO, handlers=log_handlers)
 
-    Returns:
-        pandas DataFrame with order data
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True, slots=True)
+class RunContext:
     """
-    # Timezone offset for each country
-    tz_offset = 8 if country == 'PH' else 7  # PH: UTC+8, VN: UTC+7
-
-    # Build hour filter if provided
-    hour_filter = ""
-    if hour_limit is not None:
-        hour_filter = f"AND HOUR(createAt + INTERVAL {tz_offset} HOUR) <= {hour_limit}"
-
-    # Build query based on country for silver tables
-    # Use QUALIFY to deduplicate append-only table data
-    # Use channel whitelist for consistent filtering
-    if country == 'PH':
-        query = f"""
+    Dates for one extraction run, captured once in main.
+
+    Every country, the raw cache and the JSON output read the same
+    snapshot, so a run that crosses midnight still reports one consistent
+    "today".
+    """
+
+    now: datetime
+    today: date
+    same_day_last_week: date
+    mtd_start: date
+    last_month_mtd_start: date
+    last_month_mtd_end: date
+
+    @classmethod
+    def capture(cls):
+        """Read the clock once and derive every date from that instant."""
+        now = hk_now()
+        today = now.date()
+        last_month_mtd_start, last_month_mtd_end = last_month_mtd_range_of(today)
+        return cls(
+            now=now,
+            today=today,
+            same_day_last_week=same_day_last_week_of(today),
+            mtd_start=mtd_start_of(today),
+            last_month_mtd_start=last_month_mtd_start,
+            last_month_mtd_end=last_month_mtd_end,
+        )
+
+
+# GMV is held in memory as integer cents (order_gmv_cents), so sums are
+# exact int64 additions; amounts are converted back to currency units only
+# in the aggregated totals
+CENTS_PER_UNIT = 100
+
+NS_PER_HOUR = 3_600_000_000_000
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+# Metric keys (in output order) produced by calculate_metrics
+METRIC_COLUMNS = [
+    "total_gmv", "total_gmv_usd", "orders", "unique_buyers", "unique_vendors",
+    "aov", "aov_usd", "frequency", "gmv_per_poc", "gmv_per_poc_usd",
+]
+
+# Explicit dtypes for raw order columns (applied by prepare_orders), so no
+# column is left to object-dtype inference. Repeated strings are categoricals:
+# channel filters and distinct counts then work on integer codes instead of
+# hashing Python strings. placement_date is handled by add_date_columns.
+ORDER_DTYPES = {
+    "order_number": "string[pyarrow]",
+    "order_gmv": "float64",
+    "account_id": "category",
+    "vendor_account_id": "category",
+    "channel": "category",
+}
+
+# Silver-layer order queries per country, bound with named parameters:
+#   :start_utc / :end_utc  - half-open UTC range on the createAt TIMESTAMP
+#                            column; the bounds are cast to TIMESTAMP so the
+#                            comparison is never string-to-string
+# Append-only table data is deduplicated client-side (see deduplicate_orders)
+# Use channel whitelist for consistent filtering
+ORDERS_QUERIES = {
+    "PH": f"""
         SELECT
-            'PH' AS country,
             createAt AS placement_date,
             orderNumber AS order_number,
             total AS order_gmv,
-            total/56.017 AS order_gmv_usd,
             beesAccountId AS account_id,
             vendorAccountId AS vendor_account_id,
-            status AS order_status,
             channel
         FROM ptn_am.silver.daily_orders_consolidated
-        WHERE TO_DATE(DATE_TRUNC('DAY', createAt + INTERVAL {tz_offset} HOUR)) >= '{start_date}'
-        AND TO_DATE(DATE_TRUNC('DAY', createAt + INTERVAL {tz_offset} HOUR)) <= '{end_date}'
+        WHERE createAt >= CAST(:start_utc AS TIMESTAMP)
+        AND createAt < CAST(:end_utc AS TIMESTAMP)
         AND channel IN ('B2B_APP', 'B2B_WEB', 'B2B_LNK', 'B2B_FORCE', 'CX_TLP')
         AND vendorAccountId NOT LIKE '%BEE%'
         AND vendorAccountId NOT LIKE '%DUM%'
         AND vendorAccountId LIKE '%#_%' ESCAPE '#'
         AND status NOT IN ('DENIED', 'CANCELLED', 'PENDING CANCELLATION')
-        {hour_filter}
-        QUALIFY ROW_NUMBER() OVER(PARTITION BY orderNumber ORDER BY createAt DESC) = 1
-        """
-    else:  # VN
-        # VN may not have underscore in vendor IDs, so make that filter optional
-        query = f"""
+        """,
+    # VN may not have underscore in vendor IDs, so make that filter optional
+    "VN": f"""
         SELECT
-            'VN' AS country,
             createAt AS placement_date,
             orderNumber AS order_number,
             total AS order_gmv,
-            total/26416 AS order_gmv_usd,
             beesAccountId AS account_id,
             vendorAccountId AS vendor_account_id,
-            status AS order_status,
             channel
         FROM ptn_am.silver.vn_daily_orders_consolidated
-        WHERE TO_DATE(DATE_TRUNC('DAY', createAt + INTERVAL {tz_offset} HOUR)) >= '{start_date}'
-        AND TO_DATE(DATE_TRUNC('DAY', createAt + INTERVAL {tz_offset} HOUR)) <= '{end_date}'
+        WHERE createAt >= CAST(:start_utc AS TIMESTAMP)
+        AND createAt < CAST(:end_utc AS TIMESTAMP)
         AND channel IN ('B2B_APP', 'B2B_WEB', 'B2B_LNK', 'B2B_FORCE', 'CX_TLP')
         AND vendorAccountId NOT LIKE '%BEE%'
         AND vendorAccountId NOT LIKE '%DUM%'
         AND status NOT IN ('DENIED', 'CANCELLED', 'PENDING CANCELLATION')
-        {hour_filter}
-        QUALIFY ROW_NUMBER() OVER(PARTITION BY orderNumber ORDER BY createAt DESC) = 1
+        """,
+}
+
+# Daily history totals reduced on the cluster: one row per local date instead
+# of every raw order. The inner QUALIFY keeps the latest row per order, the
+# same deduplication deduplicate_orders applies to raw rows. It runs over the
+# whole range up to today, so an order whose latest row falls in the raw window
+# is not also counted on an earlier history day; only then are rows before
+# :until_utc (the end of the history days) kept.
+DAILY_AGGREGATES_QUERIES = {
+    country: f"""
+        SELECT
+            TO_DATE(placement_date + INTERVAL {TZ_OFFSETS[country]} HOUR) AS date,
+            SUM(order_gmv) AS total_gmv,
+            COUNT(DISTINCT order_number) AS orders,
+            COUNT(DISTINCT account_id) AS unique_buyers,
+            COUNT(DISTINCT vendor_account_id) AS unique_vendors
+        FROM (
+            {query}
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY orderNumber ORDER BY createAt DESC) = 1
+        )
+        WHERE placement_date < CAST(:until_utc AS TIMESTAMP)
+        GROUP BY 1
+        ORDER BY 1
         """
+    for country, query in ORDERS_QUERIES.items()
+}
+
+
+def connect_to_databricks(max_retries=5, base_delay=1.0, max_delay=20.0):
+    """
+    Connect to Databricks with retry logic.
+
+    Transient failures (Databricks operational errors such as 503s, and
+    socket/TLS errors) are retried with exponential backoff plus jitter:
+    roughly 1s, 2s, 4s, 8s between the 5 attempts, capped at max_delay.
+    Any other error is raised immediately.
+    """
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Connecting to Databricks (attempt {attempt + 1}/{max_retries})...")
+            connection = sql.connect(
+                server_hostname=DATABRICKS_SERVER_HOSTNAME,
+                http_path=DATABRICKS_HTTP_PATH,
+                access_token=DATABRICKS_TOKEN,
+                use_inline_params=DATABRICKS_INLINE_PARAMS,
+            )
+            logger.info("Successfully connected to Databricks")
+            return connection
+        except (OperationalError, OSError) as e:
+            logger.error(f"Connection attempt {attempt + 1} failed: {e}")
+            if attempt == max_retries - 1:
+                logger.error("All connection attempts failed")
+                raise
+
+            delay = min(max_delay, base_delay * 2 ** attempt) + random.uniform(0, 0.5)
+            time.sleep(delay)
+
+    return None
+
+
+# One Databricks session per query thread, reused for every query that thread
+# runs; connections are not shared across threads. The query threads form one
+# fixed pool shared by all countries (see main), so a run opens at most
+# QUERY_WORKERS sessions.
+_thread_connections = threading.local()
+_open_connections = []
+_open_connections_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    Get the calling thread's Databricks connection, connecting on first use.
+
+    Connections stay open until close_connections, which main calls once the
+    query pool is shut down (and which also runs at exit), so later queries on
+    the same thread reuse the session instead of setting up a new one.
+    """
+    connection = getattr(_thread_connections, "connection", None)
+    if connection is None:
+        connection = connect_to_databricks()
+        _thread_connections.connection = connection
+        with _open_connections_lock:
+            _open_connections.append(connection)
+    return connection
+
+
+@atexit.register
+def close_connections():
+    """Close every connection opened by get_connection."""
+    with _open_connections_lock:
+        while _open_connections:
+            connection = _open_connections.pop()
+            try:
+                connection.close()
+            except Exception as e:
+                logger.warning(f"Failed to close Databricks connection: {e}")
+
+
+def arrow_to_pandas(table):
+    """
+    Convert an Arrow result table to a pandas DataFrame.
+
+    Decimal columns (e.g. order totals) are cast to float64 on the Arrow side so
+    metric calculations run on native numeric columns instead of Decimal objects.
+    Each column becomes its own pandas block (no consolidation copy into 2-D
+    blocks).
+
+    Args:
+        table: pyarrow Table returned by the Databricks cursor
+
+    Returns:
+        pandas DataFrame with the result columns
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+
+    return table.to_pandas(split_blocks=True)
+
+
+def add_date_columns(df, country):
+    """
+    Parse placement_date once and add the date columns used downstream.
+
+    Adds:
+        local_date: Calendar date in the country's timezone, as a midnight
+            datetime64 timestamp so filters and groupby stay vectorized
+        local_hour: Hour of day (0-23) in the country's timezone
+
+    Args:
+        df: pandas DataFrame with a placement_date column
+        country: Country code (PH or VN) for the timezone offset
+
+    Returns:
+        The same DataFrame with placement_date as UTC timestamps
+    """
+    placement = df["placement_date"]
+    if isinstance(placement.dtype, pd.DatetimeTZDtype):
+        # Arrow timestamps arrive tz-aware, no string parsing needed
+        placement_utc = placement.dt.tz_convert("UTC")
+    else:
+        # String timestamps are ISO8601 (with or without fractional seconds and
+        # offsets); the ISO8601 parser is vectorized, unlike format='mixed'
+        # which falls back to dateutil per value
+        placement_utc = pd.to_datetime(placement, format='ISO8601', utc=True)
+
+    # Shift to local time and split into day/hour on raw int64 nanoseconds,
+    # which skips pandas' per-element datetime accessors
+    local_ns = (
+        placement_utc.dt.tz_localize(None).to_numpy().astype("datetime64[ns]").view("i8")
+        + TZ_OFFSETS[country] * NS_PER_HOUR
+    )
+    df["placement_date"] = placement_utc
+    df["local_date"] = (local_ns - local_ns % NS_PER_DAY).view("datetime64[ns]")
+    df["local_hour"] = (local_ns // NS_PER_HOUR % 24).astype(np.int32)
+
+    return df
+
+
+def deduplicate_orders(df):
+    """
+    Keep only the latest row for each order number.
+
+    The silver tables are append-only, so an order can appear more than once.
+    Deduplicating here replaces a server-side ROW_NUMBER() window, which had to
+    sort every row on the cluster.
+
+    Args:
+        df: pandas DataFrame with parsed placement_date column
+
+    Returns:
+        pandas DataFrame with one row per order_number
+    """
+    if df.empty:
+        return df
+
+    return (
+        df.sort_values("placement_date", kind="stable")
+        .drop_duplicates("order_number", keep="last")
+        .reset_index(drop=True)
+    )
+
+
+def iter_arrow_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    """
+    Yield Arrow batches from an executed cursor until it is exhausted.
+
+    Args:
+        cursor: Databricks cursor with an executed query
+        batch_size: Maximum number of rows per batch
+
+    Yields:
+        pyarrow Table with at most batch_size rows
+    """
+    while True:
+        batch = cursor.fetchmany_arrow(batch_size)
+        if batch.num_rows == 0:
+            break
+        yield batch
+
+
+def render_query(query):
+    """
+    Adapt the :name parameter markers to the connection's parameter style.
+
+    Native parameters use the markers as written. Inline parameters are
+    substituted client-side with pyformat, so markers become %(name)s and
+    literal percent signs (LIKE patterns) are doubled.
+    """
+    if not DATABRICKS_INLINE_PARAMS:
+        return query
+    return re.sub(r"(?<![:\w]):(\w+)", r"%(\1)s", query.replace("%", "%%"))
+
+
+def run_query(cursor, query, parameters=None):
+    """
+    Execute a query on an open cursor and fetch the results as a DataFrame.
+
+    Args:
+        cursor: Databricks cursor (reused across queries)
+        query: SQL query string with :name parameter markers
+        parameters: Optional dict of named query parameters
+
+    Returns:
+        pandas DataFrame with the query results (empty if no rows)
+    """
+    cursor.execute(render_query(query), parameters)
+
+    # Stream results in Arrow batches and convert each one as it arrives,
+    # so the raw result never sits in memory alongside the DataFrame
+    frames = [arrow_to_pandas(batch) for batch in iter_arrow_batches(cursor)]
+
+    if not frames:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def local_range_parameters(country, start_date, end_date):
+    """
+    Build the named query parameters for a local date range.
+
+    Translates the local date range into UTC bounds on the raw createAt column.
+    Filtering on createAt directly (instead of a shifted, truncated expression)
+    lets Databricks prune files/partitions using column statistics. The bounds
+    carry an explicit UTC offset and are cast to TIMESTAMP in the query, so
+    the comparison is chronological whatever the session time zone is.
+
+    Args:
+        country: Country code (PH or VN)
+        start_date: Start date (inclusive)
+        end_date: End date (inclusive)
+
+    Returns:
+        dict with start_utc and end_utc parameters
+    """
+    # Timezone offset for each country
+    tz_offset = TZ_OFFSETS[country]
+
+    start_utc = datetime.combine(start_date, datetime.min.time()) - timedelta(hours=tz_offset)
+    end_utc = datetime.combine(end_date + timedelta(days=1), datetime.min.time()) - timedelta(hours=tz_offset)
+
+    return {
+        "start_utc": start_utc.strftime("%Y-%m-%d %H:%M:%S+00:00"),
+        "end_utc": end_utc.strftime("%Y-%m-%d %H:%M:%S+00:00"),
+    }
+
+
+def fetch_orders(cursor, country, start_date, end_date):
+    """
+    Fetch raw order rows from the Databricks silver layer.
+
+    Args:
+        cursor: Databricks cursor (reused across queries)
+        country: Country code (PH or VN)
+        start_date: Start date (inclusive)
+        end_date: End date (inclusive)
+
+    Returns:
+        pandas DataFrame with raw order rows (empty if no rows)
+    """
+    # Only the bounds vary between calls, so the SQL text stays
+    # constant and Databricks can reuse the compiled plan
+    query = ORDERS_QUERIES[country]
+    parameters = local_range_parameters(country, start_date, end_date)
 
     logger.info(f"Querying orders for {country} from {start_date} to {end_date}")
+    return run_query(cursor, query, parameters)
+
+
+def query_daily_aggregates(cursor, country, start_date, end_date, dedup_end_date):
+    """
+    Query per-day order totals, aggregated in Databricks.
+
+    Used for history days outside the raw order window, so only one row
+    per day crosses the wire. Orders are deduplicated over start_date to
+    dedup_end_date, like the raw window that follows the history days, so an
+    order is counted once on the day of its latest row.
+
+    Args:
+        cursor: Databricks cursor (reused across queries)
+        country: Country code (PH or VN)
+        start_date: Start date (inclusive)
+        end_date: Last history date returned (inclusive)
+        dedup_end_date: Last date considered for deduplication (inclusive)
+
+    Returns:
+        DataFrame indexed by local date with total_gmv, orders,
+        unique_buyers and unique_vendors columns
+    """
+    logger.info(f"Querying daily aggregates for {country} from {start_date} to {end_date}")
+    parameters = {
+        **local_range_parameters(country, start_date, dedup_end_date),
+        "until_utc": local_range_parameters(country, start_date, end_date)["end_utc"],
+    }
+    df = run_query(cursor, DAILY_AGGREGATES_QUERIES[country], parameters)
+
+    if df.empty:
+        # Typed like a real result so concatenating it keeps numeric columns
+        return pd.DataFrame(
+            {
+                "total_gmv": pd.Series(dtype="float64"),
+                "orders": pd.Series(dtype="int64"),
+                "unique_buyers": pd.Series(dtype="int64"),
+                "unique_vendors": pd.Series(dtype="int64"),
+            },
+            index=pd.DatetimeIndex([], name="date"),
+        )
+
+    # Same datetime64 day keys as the local_date column
+    df["date"] = pd.to_datetime(df["date"])
+    return df.set_index("date")
+
+
+def prepare_orders(df, country):
+    """
+    Normalize raw order rows: dtypes and date columns.
+
+    Rows are not deduplicated here: same-time slices have to drop rows past
+    the current hour before picking each order's latest row, as the original
+    per-slice queries did (see process_country).
+
+    Args:
+        df: pandas DataFrame with raw order rows (from Databricks or the cache)
+        country: Country code (PH or VN)
+
+    Returns:
+        pandas DataFrame with one row per raw order row
+    """
+    # Databricks may return strings for numeric columns; coerce before the
+    # dtype map so bad values become NaN instead of raising
+    df["order_gmv"] = pd.to_numeric(df["order_gmv"], errors='coerce')
+    df = df.astype(ORDER_DTYPES)
+
+    # Totals have two decimals, so cents are exact. Unparseable totals count
+    # as 0, as they did when skipped by the float sums.
+    df["order_gmv_cents"] = (df.pop("order_gmv") * CENTS_PER_UNIT).round().fillna(0).astype("int64")
+
+    return add_date_columns(df, country)
+
+
+def cache_country_dir(country):
+    """Get the raw-order Parquet cache directory for a country."""
+    return Path(RAW_CACHE_DIR) / f"country={country}"
+
+
+# Cache partition contents: one Parquet file per day with orders, or an empty
+# marker for a settled day without any (so it's not queried again every run)
+CACHE_PART_FILE = "part-0.parquet"
+CACHE_EMPTY_MARKER = "_EMPTY"
+
+
+def cache_partition_dir(country, day):
+    """Get the cache partition directory for one local date."""
+    return cache_country_dir(country) / f"local_date={day:%Y-%m-%d}"
+
+
+def first_uncached_day(country, start_date, end_date, today):
+    """
+    Find the first day in a range that has to be queried from Databricks.
+
+    Only settled days (at least RAW_CACHE_SETTLE_DAYS old) are served from the
+    cache; everything from the first missing or unsettled day onward is queried.
+
+    Args:
+        country: Country code (PH or VN)
+        start_date: Start date (inclusive)
+        end_date: End date (inclusive)
+        today: The run's date (RunContext.today) that settling is measured from
+
+    Returns:
+        First date to query (end_date + 1 day if the whole range is cached)
+    """
+    settled_end = min(end_date, today - timedelta(days=RAW_CACHE_SETTLE_DAYS))
+    country_dir = cache_country_dir(country)
+    cached_days = {
+        path.parent.name.removeprefix("local_date=")
+        for name in (CACHE_PART_FILE, CACHE_EMPTY_MARKER)
+        for path in country_dir.glob(f"local_date=*/{name}")
+    }
+
+    day = start_date
+    while day <= settled_end and day.isoformat() in cached_days:
+        day += timedelta(days=1)
+
+    return day
+
+
+def read_cached_orders(country, start_date, end_date):
+    """
+    Read cached raw order rows for local dates in [start_date, end_date).
+
+    Only the data files of the requested days are read; days cached as empty
+    contribute no file.
+    """
+    paths = [
+        path
+        for offset in range((end_date - start_date).days)
+        if (path := cache_partition_dir(country, start_date + timedelta(days=offset)) / CACHE_PART_FILE).exists()
+    ]
+    if not paths:
+        return pd.DataFrame()
+
+    return pd.read_parquet(
+        [str(path) for path in paths],
+        # Only the projected query columns, even from days cached with a wider one
+        columns=["placement_date", *ORDER_DTYPES],
+    )
+
+
+def write_cache_file(df, path):
+    """
+    Write a cache partition file atomically.
+
+    Like write_json, the rows go to a temporary file that replaces path in
+    one rename, so a killed run or a concurrent reader never sees a truncated
+    file. The temporary name is dot-prefixed, which Parquet dataset discovery
+    skips, and unique per thread since both query threads may write a day.
+    """
+    tmp_path = path.with_name(f".{path.name}.tmp.{os.getpid()}.{threading.get_ident()}")
+    try:
+        with open(tmp_path, "wb") as f:
+            df.to_parquet(f, index=False)
+            f.flush()
+            sync_data(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
 
+
+def write_cached_orders(df, country, start_date, end_date, today):
+    """
+    Write settled days in [start_date, end_date] to the Parquet cache.
+
+    Each local date is written as its own partition, replacing any previous
+    file for that day. Rows are stored with the raw query columns (GMV in
+    currency units), so cached and fresh rows share one schema. Settled days
+    without orders get an empty marker instead of a file.
+
+    Args:
+        df: Prepared order DataFrame (with local_date column)
+        country: Country code (PH or VN)
+        start_date: First freshly queried date
+        end_date: Last freshly queried date
+        today: The run's date (RunContext.today) that settling is measured from
+    """
+    settled_end = min(end_date, today - timedelta(days=RAW_CACHE_SETTLE_DAYS))
+    days = dict(tuple(df.groupby("local_date"))) if not df.empty else {}
+
+    day = start_date
+    while day <= settled_end:
+        partition_dir = cache_partition_dir(country, day)
+        partition_dir.mkdir(parents=True, exist_ok=True)
+
+        day_df = days.get(pd.Timestamp(day))
+        if day_df is None:
+            (partition_dir / CACHE_EMPTY_MARKER).touch()
+        else:
+            raw_day_df = day_df.drop(columns=["local_date", "local_hour", "order_gmv_cents"])
+            raw_day_df["order_gmv"] = day_df["order_gmv_cents"] / CENTS_PER_UNIT
+            write_cache_file(raw_day_df, partition_dir / CACHE_PART_FILE)
+
+        day += timedelta(days=1)
+
+
+def query_orders(cursor, country, start_date, end_date, today):
+    """
+    Query orders for a specific country and date range.
+
+    Settled days are memoized across runs in a Parquet cache (RAW_CACHE_DIR,
+    partitioned by country and local date), so only the uncached tail of the
+    range is queried from the Databricks silver layer.
+
+    The returned rows are not deduplicated; callers apply deduplicate_orders
+    after any row filters of their own.
+
+    Args:
+        cursor: Databricks cursor (reused across queries)
+        country: Country code (PH or VN)
+        start_date: Start date (inclusive)
+        end_date: End date (inclusive)
+        today: The run's date (RunContext.today), which decides the settled days
+
+    Returns:
+        pandas DataFrame with raw order rows
+    """
     try:
-        cursor = connection.cursor()
-        cursor.execute(query)
+        frames = []
+
+        fetch_start = first_uncached_day(country, start_date, end_date, today)
+        if fetch_start > start_date:
+            logger.info(f"{country} - Reading cached orders from {start_date} to {fetch_start - timedelta(days=1)}")
+            frames.append(read_cached_orders(country, start_date, fetch_start))
+
+        if fetch_start <= end_date:
+            frames.append(fetch_orders(cursor, country, fetch_start, end_date))
 
-        # Fetch results
-        columns = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
+        frames = [frame for frame in frames if not frame.empty]
+        df = prepare_orders(pd.concat(frames, ignore_index=True), country) if frames else pd.DataFrame()
 
-        if not rows:
+        # Cache settled days even when they had no orders
+        if fetch_start <= end_date:
+            write_cached_orders(df, country, fetch_start, end_date, today)
+
+        if df.empty:
             logger.warning(f"No data returned for {country}")
-            return pd.DataFrame()
+            return df
 
-        df = pd.DataFrame(rows, columns=columns)
-        logger.info(f"Retrieved {len(df)} orders for {country}")
+        logger.info(f"Retrieved {len(df)} order rows for {country}")
 
-        cursor.close()
         return df
 
     except Exception as e:
@@ -169,6 +728,36 @@ def query_orders(connection, country, start_date, end_date, hour_limit=None):
         raise
 
 
+def derive_metrics(totals, country=None):
+    """
+    Derive ratio and USD metrics from aggregated order totals.
+
+    Works column-wise, so one call covers a single period or every day of a
+    daily aggregate, and rounding happens once for the whole frame.
+
+    Args:
+        totals: DataFrame with total_gmv, orders, unique_buyers and unique_vendors columns
+        country: Country code (PH or VN) for USD conversion
+
+    Returns:
+        DataFrame with METRIC_COLUMNS, rounded to 2 decimals
+    """
+    totals = totals.copy()
+
+    # Calculate derived metrics (0 when the denominator is 0)
+    totals["aov"] = (totals["total_gmv"] / totals["orders"].where(totals["orders"] > 0)).fillna(0)
+    totals["frequency"] = (totals["orders"] / totals["unique_buyers"].where(totals["unique_buyers"] > 0)).fillna(0)
+    totals["gmv_per_poc"] = (totals["total_gmv"] / totals["unique_vendors"].where(totals["unique_vendors"] > 0)).fillna(0)
+
+    # Calculate USD values
+    usd_recip = CURRENCY_RECIP.get(country, 1) if country else 1
+    totals["total_gmv_usd"] = totals["total_gmv"] * usd_recip
+    totals["aov_usd"] = totals["aov"] * usd_recip
+    totals["gmv_per_poc_usd"] = totals["gmv_per_poc"] * usd_recip
+
+    return totals[METRIC_COLUMNS].round(2)
+
+
 def calculate_metrics(df, country=None):
     """
     Calculate sales metrics from order data.
@@ -194,37 +783,76 @@ def calculate_metrics(df, country=None):
             "gmv_per_poc_usd": 0,
         }
 
-    # Convert numeric columns to proper types (Databricks may return strings)
-    df["order_gmv"] = pd.to_numeric(df["order_gmv"], errors='coerce')
+    # One agg call for the sum and the distinct counts. Rows are deduplicated
+    # by order number, so the order count is the row count.
+    aggregated = df.agg({
+        "order_gmv_cents": "sum",
+        "account_id": "nunique",
+        "vendor_account_id": "nunique",
+    })
+    totals = pd.DataFrame([{
+        "total_gmv": aggregated["order_gmv_cents"] / CENTS_PER_UNIT,
+        "orders": len(df),
+        "unique_buyers": int(aggregated["account_id"]),
+        "unique_vendors": int(aggregated["vendor_account_id"]),
+    }])
 
-    total_gmv = df["order_gmv"].sum()
-    orders = df["order_number"].nunique()
-    unique_buyers = df["account_id"].nunique()
-    unique_vendors = df["vendor_account_id"].nunique()
+    return derive_metrics(totals, country).to_dict(orient="records")[0]
 
-    # Calculate derived metrics
-    aov = total_gmv / orders if orders > 0 else 0
-    frequency = orders / unique_buyers if unique_buyers > 0 else 0
-    gmv_per_poc = total_gmv / unique_vendors if unique_vendors > 0 else 0
 
-    # Calculate USD values
-    usd_rate = CURRENCY_RATES.get(country, 1) if country else 1
-    total_gmv_usd = total_gmv / usd_rate
-    aov_usd = aov / usd_rate
-    gmv_per_poc_usd = gmv_per_poc / usd_rate
+def aggregate_totals(df, key):
+    """
+    Aggregate order totals for every group of a key column in one pass.
 
-    return {
-        "total_gmv": round(total_gmv, 2),
-        "total_gmv_usd": round(total_gmv_usd, 2),
-        "orders": orders,
-        "unique_buyers": unique_buyers,
-        "unique_vendors": unique_vendors,
-        "aov": round(aov, 2),
-        "aov_usd": round(aov_usd, 2),
-        "frequency": round(frequency, 2),
-        "gmv_per_poc": round(gmv_per_poc, 2),
-        "gmv_per_poc_usd": round(gmv_per_poc_usd, 2),
-    }
+    Args:
+        df: pandas DataFrame with order data, one row per order (see
+            deduplicate_orders), so orders are counted by group size
+        key: Column to group by (e.g. local_date)
+
+    Returns:
+        DataFrame indexed by key (sorted) with total_gmv, orders,
+        unique_buyers and unique_vendors columns
+    """
+    totals = df.groupby(key, sort=True).agg(
+        total_gmv=("order_gmv_cents", "sum"),
+        orders=("order_number", "size"),
+        unique_buyers=("account_id", "nunique"),
+        unique_vendors=("vendor_account_id", "nunique"),
+    )
+    totals["total_gmv"] = totals["total_gmv"] / CENTS_PER_UNIT
+    return totals
+
+
+def calculate_grouped_metrics(df, key, country=None):
+    """
+    Calculate sales metrics for every group of a key column in one pass.
+
+    Args:
+        df: pandas DataFrame with order data
+        key: Column to group by (e.g. local_date)
+        country: Country code (PH or VN) for USD conversion
+
+    Returns:
+        DataFrame indexed by key (sorted) with METRIC_COLUMNS
+    """
+    return derive_metrics(aggregate_totals(df, key), country)
+
+
+def lookup_metrics(grouped, key, country=None):
+    """
+    Get one group's metrics from calculate_grouped_metrics as a dict.
+
+    Args:
+        grouped: DataFrame returned by calculate_grouped_metrics
+        key: Group key to look up
+        country: Country code, used for the empty metrics when the key is missing
+
+    Returns:
+        dict with calculated metrics (all zeros if the group has no orders)
+    """
+    if key not in grouped.index:
+        return calculate_metrics(pd.DataFrame(), country)
+    return grouped.loc[[key]].to_dict(orient="records")[0]
 
 
 def calculate_channel_metrics(df, country=None):
@@ -249,157 +877,146 @@ def calculate_channel_metrics(df, country=None):
             "cx_tlp": {"gmv_usd": 0, "orders": 0, "buyers": 0, "gmv_percent": 0, "orders_percent": 0, "buyers_percent": 0}
         }
 
-    # Create explicit copy to avoid SettingWithCopyWarning
-    df = df.copy()
-
-    # Convert numeric columns
-    df["order_gmv"] = pd.to_numeric(df["order_gmv"], errors='coerce')
-    usd_rate = CURRENCY_RATES.get(country, 1) if country else 1
+    usd_recip = CURRENCY_RECIP.get(country, 1) if country else 1
 
     # Total metrics
-    total_gmv = df["order_gmv"].sum()
-    total_gmv_usd = total_gmv / usd_rate
-    total_orders = df["order_number"].nunique()
-    total_buyers = df["account_id"].nunique()
+    total_gmv = df["order_gmv_cents"].sum() / CENTS_PER_UNIT
+    total_gmv_usd = total_gmv * usd_recip
+    total_orders = len(df)
 
     # MUTUALLY EXCLUSIVE BUYER CLASSIFICATION
-    # Get buyers who have at least one Customer channel order
-    customer_buyers_set = set(df[df["channel"] != "CX_TLP"]["account_id"].unique())
-
-    # All other buyers are Grow (only CX_TLP orders)
-    all_buyers_set = set(df["account_id"].unique())
-    grow_buyers_set = all_buyers_set - customer_buyers_set
-
-    # Customer metrics (all orders from customer-classified buyers)
-    df_customer = df[df["account_id"].isin(customer_buyers_set)]
-    customer_gmv = df_customer["order_gmv"].sum()
-    customer_gmv_usd = customer_gmv / usd_rate
-    customer_orders = df_customer["order_number"].nunique()
-    customer_buyers = len(customer_buyers_set)
-
-    # Grow metrics (all orders from grow-classified buyers)
-    df_grow = df[df["account_id"].isin(grow_buyers_set)]
-    grow_gmv = df_grow["order_gmv"].sum()
-    grow_gmv_usd = grow_gmv / usd_rate
-    grow_orders = df_grow["order_number"].nunique()
-    grow_buyers = len(grow_buyers_set)
+    # Buyers with at least one Customer channel order are Customer,
+    # all other buyers are Grow (only CX_TLP orders).
+    # Works on the account_id category codes, shifted by one so missing
+    # accounts (code -1) share slot 0. As in the original set-based version,
+    # orders without an account count as one buyer, classified like any other
+    account_codes = df["account_id"].astype("category").cat.codes.to_numpy().astype(np.int64) + 1
+    n_slots = account_codes.max() + 1
+    has_customer_order = np.zeros(n_slots, dtype=bool)
+    has_customer_order[account_codes[(df["channel"] != "CX_TLP").to_numpy()]] = True
+    has_order = np.zeros(n_slots, dtype=bool)
+    has_order[account_codes] = True
+
+    # One boolean mask per row instead of a groupby over two filtered copies
+    is_customer = has_customer_order[account_codes]
+    gmv_cents = df["order_gmv_cents"].to_numpy()
+    customer_orders = int(np.count_nonzero(is_customer))
+    customer_buyers = int(np.count_nonzero(has_order & has_customer_order))
+
+    buckets = pd.DataFrame(
+        {
+            "gmv": [
+                gmv_cents[is_customer].sum() / CENTS_PER_UNIT,
+                gmv_cents[~is_customer].sum() / CENTS_PER_UNIT,
+            ],
+            "orders": [customer_orders, len(df) - customer_orders],
+            "buyers": [customer_buyers, int(np.count_nonzero(has_order)) - customer_buyers],
+        },
+        index=["customer", "cx_tlp"],
+    )
+    buckets["gmv_usd"] = buckets["gmv"] * usd_recip
 
     # Calculate percentages
     # For buyers, use the sum of classified buyers to ensure 100% sum
-    classified_buyers_total = customer_buyers + grow_buyers
+    classified_buyers_total = buckets["buyers"].sum()
 
-    customer_gmv_pct = (customer_gmv_usd / total_gmv_usd * 100) if total_gmv_usd > 0 else 0
-    customer_orders_pct = (customer_orders / total_orders * 100) if total_orders > 0 else 0
-    customer_buyers_pct = (customer_buyers / classified_buyers_total * 100) if classified_buyers_total > 0 else 0
+    buckets["gmv_percent"] = (buckets["gmv_usd"] / total_gmv_usd * 100) if total_gmv_usd > 0 else 0
+    buckets["orders_percent"] = (buckets["orders"] / total_orders * 100) if total_orders > 0 else 0
+    buckets["buyers_percent"] = (buckets["buyers"] / classified_buyers_total * 100) if classified_buyers_total > 0 else 0
 
-    grow_gmv_pct = (grow_gmv_usd / total_gmv_usd * 100) if total_gmv_usd > 0 else 0
-    grow_orders_pct = (grow_orders / total_orders * 100) if total_orders > 0 else 0
-    grow_buyers_pct = (grow_buyers / classified_buyers_total * 100) if classified_buyers_total > 0 else 0
+    columns = ["gmv_usd", "orders", "buyers", "gmv_percent", "orders_percent", "buyers_percent"]
+    buckets = buckets[columns].round({"gmv_usd": 2, "gmv_percent": 1, "orders_percent": 1, "buyers_percent": 1})
 
-    return {
-        "customer": {
-            "gmv_usd": round(customer_gmv_usd, 2),
-            "orders": customer_orders,
-            "buyers": customer_buyers,
-            "gmv_percent": round(customer_gmv_pct, 1),
-            "orders_percent": round(customer_orders_pct, 1),
-            "buyers_percent": round(customer_buyers_pct, 1)
-        },
-        "cx_tlp": {
-            "gmv_usd": round(grow_gmv_usd, 2),
-            "orders": grow_orders,
-            "buyers": grow_buyers,
-            "gmv_percent": round(grow_gmv_pct, 1),
-            "orders_percent": round(grow_orders_pct, 1),
-            "buyers_percent": round(grow_buyers_pct, 1)
-        }
-    }
+    return buckets.to_dict(orient="index")
 
 
-def calculate_daily_metrics(df, country=None):
+def calculate_daily_metrics(daily_totals, country=None):
     """
-    Calculate metrics grouped by day.
+    Calculate metrics for each day from per-day order totals.
 
     Args:
-        df: pandas DataFrame with order data
+        daily_totals: DataFrame indexed by local date with total_gmv, orders,
+            unique_buyers and unique_vendors columns (from aggregate_totals or
+            query_daily_aggregates)
         country: Country code (PH or VN) for USD conversion
 
     Returns:
-        list of dicts with daily metrics
+        DataFrame indexed by local date (sorted) with METRIC_COLUMNS
     """
-    if df.empty:
-        return []
+    return derive_metrics(daily_totals.sort_index(), country)
 
-    # Create explicit copy to avoid SettingWithCopyWarning
-    df = df.copy()
 
-    # Convert placement_date to date (handle mixed ISO8601 formats)
-    df["date"] = pd.to_datetime(df["placement_date"], format='mixed', utc=True).dt.date
+def daily_metrics_records(daily):
+    """
+    Convert daily metrics from calculate_daily_metrics to output records.
 
-    daily_metrics = []
-    for date, group in df.groupby("date"):
-        metrics = calculate_metrics(group, country)
-        metrics["date"] = str(date)
-        daily_metrics.append(metrics)
+    Args:
+        daily: DataFrame indexed by local date with METRIC_COLUMNS
 
-    # Sort by date
-    daily_metrics.sort(key=lambda x: x["date"])
+    Returns:
+        list of dicts with daily metrics and their date, sorted by date
+    """
+    records = daily[METRIC_COLUMNS].copy()
+    records["date"] = daily.index.strftime("%Y-%m-%d")
 
-    return daily_metrics
+    # Same key order as calculate_metrics
+    return records.to_dict(orient="records")
 
 
-def calculate_moving_average(daily_metrics, window):
+# Moving average output key -> daily metric field (USD values for monetary metrics)
+MOVING_AVERAGE_FIELDS = {
+    "gmv": "total_gmv_usd",
+    "orders": "orders",
+    "aov": "aov_usd",
+    "unique_buyers": "unique_buyers",
+    "frequency": "frequency",
+    "gmv_per_poc": "gmv_per_poc_usd",
+}
+
+
+def calculate_moving_averages(daily, windows):
     """
-    Calculate moving average for metrics.
+    Calculate moving averages for metrics over several windows.
+
+    The daily values are taken as one array and summed cumulatively once;
+    each window's sum is then the difference of two rows of the running total.
 
     Args:
-        daily_metrics: list of daily metric dicts
-        window: number of days for moving average
+        daily: DataFrame of daily metrics from calculate_daily_metrics, sorted by date
+        windows: numbers of days for the moving averages
 
     Returns:
-        dict with moving average metrics
+        list with one moving average metrics dict per window
     """
-    if len(daily_metrics) < window:
-        logger.warning(f"Not enough data for {window}-day moving average")
-        window = len(daily_metrics)
+    values = daily[list(MOVING_AVERAGE_FIELDS.values())].to_numpy(dtype=np.float64)
 
-    if window == 0:
-        return {
-            "gmv": 0,
-            "orders": 0,
-            "aov": 0,
-            "unique_buyers": 0,
-            "frequency": 0,
-            "gmv_per_poc": 0,
-        }
+    # Leading zero row so cumulative[-1] - cumulative[-window - 1] is the sum of the last `window` days
+    cumulative = np.zeros((len(values) + 1, values.shape[1]))
+    np.cumsum(values, axis=0, out=cumulative[1:])
 
-    # Get last N days
-    recent_data = daily_metrics[-window:]
+    averages = []
+    for window in windows:
+        if len(values) < window:
+            logger.warning(f"Not enough data for {window}-day moving average")
+            window = len(values)
 
-    # Calculate averages (use USD values for monetary metrics)
-    avg_gmv = sum(d.get("total_gmv_usd", d.get("total_gmv", 0)) for d in recent_data) / window
-    avg_orders = sum(d["orders"] for d in recent_data) / window
-    avg_aov = sum(d.get("aov_usd", d.get("aov", 0)) for d in recent_data) / window
-    avg_buyers = sum(d["unique_buyers"] for d in recent_data) / window
-    avg_frequency = sum(d["frequency"] for d in recent_data) / window
-    avg_gmv_per_poc = sum(d.get("gmv_per_poc_usd", d.get("gmv_per_poc", 0)) for d in recent_data) / window
+        if window == 0:
+            averages.append(dict.fromkeys(MOVING_AVERAGE_FIELDS, 0))
+            continue
 
-    return {
-        "gmv": round(avg_gmv, 2),
-        "orders": round(avg_orders, 2),
-        "aov": round(avg_aov, 2),
-        "unique_buyers": round(avg_buyers, 2),
-        "frequency": round(avg_frequency, 2),
-        "gmv_per_poc": round(avg_gmv_per_poc, 2),
-    }
+        average = (cumulative[-1] - cumulative[-window - 1]) / window
+        averages.append(dict(zip(MOVING_AVERAGE_FIELDS, average.round(2).tolist())))
+
+    return averages
 
 
-def generate_json_output(country, metrics_today, metrics_last_week, metrics_mtd, metrics_mtd_last_month, daily_metrics, ma_7d, ma_15d, channel_metrics_today=None, channel_metrics_last_week=None, channel_metrics_mtd=None, channel_metrics_mtd_last_month=None):
+def generate_json_output(country, context, metrics_today, metrics_last_week, metrics_mtd, metrics_mtd_last_month, daily_metrics, ma_7d, ma_15d, channel_metrics_today=None, channel_metrics_last_week=None, channel_metrics_mtd=None, channel_metrics_mtd_last_month=None):
     """
     Generate JSON output structure for a country.
 
     Args:
         country: Country code
+        context: RunContext with the run's dates
         metrics_today: Today's metrics dict
         metrics_last_week: Same day last week metrics dict
         metrics_mtd: Month-to-date metrics dict
@@ -415,29 +1032,29 @@ def generate_json_output(country, metrics_today, metrics_last_week, metrics_mtd,
     Returns:
         dict ready for JSON serialization
     """
-    today = get_today()
-    same_day_last_week = get_same_day_last_week()
-    mtd_start = get_mtd_start()
-    last_month_mtd_start, last_month_mtd_end = get_last_month_mtd_range()
+    today = context.today
+    same_day_last_week = context.same_day_last_week
+    mtd_start = context.mtd_start
+    last_month_mtd_start, last_month_mtd_end = context.last_month_mtd_start, context.last_month_mtd_end
 
     output = {
-        "last_updated": datetime.now().isoformat() + "Z",
+        "last_updated": context.now.astimezone(timezone.utc).isoformat(),
         "today": {
-            "date": str(today),
+            "date": today,
             **metrics_today
         },
         "same_day_last_week": {
-            "date": str(same_day_last_week),
+            "date": same_day_last_week,
             **metrics_last_week
         },
         "mtd": {
-            "start_date": str(mtd_start),
-            "end_date": str(today),
+            "start_date": mtd_start,
+            "end_date": today,
             **metrics_mtd
         },
         "mtd_last_month": {
-            "start_date": str(last_month_mtd_start),
-            "end_date": str(last_month_mtd_end),
+            "start_date": last_month_mtd_start,
+            "end_date": last_month_mtd_end,
             **metrics_mtd_last_month
         },
         "daily_history": daily_metrics,
@@ -460,16 +1077,66 @@ def generate_json_output(country, metrics_today, metrics_last_week, metrics_mtd,
     return output
 
 
+# fdatasync is POSIX-only (missing on macOS/Windows); fsync is the fallback
+sync_data = getattr(os, "fdatasync", os.fsync)
+
+
+def write_json(filename, data):
+    """
+    Serialize data to JSON with orjson and write it to filename atomically.
+
+    The payload goes to a temporary file in the same directory, is flushed to
+    disk, and then replaces filename in one rename, so the dashboard never
+    reads a partially written file.
+
+    Args:
+        filename: Destination path
+        data: JSON-serializable data (numpy scalars and dates are supported)
+    """
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+
+    tmp_filename = f"{filename}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(payload)
+            f.flush()
+            # Only the data has to reach disk before the rename; fdatasync
+            # skips the metadata-only flush where it is available
+            sync_data(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        Path(tmp_filename).unlink(missing_ok=True)
+        raise
+
+
+def link_json(src, dst):
+    """
+    Atomically replace dst with a hard link to src.
+
+    Falls back to copying the file where hard links aren't supported.
+    """
+    tmp_filename = f"{dst}.tmp.{os.getpid()}"
+    try:
+        try:
+            os.link(src, tmp_filename)
+        except OSError:
+            shutil.copyfile(src, tmp_filename)
+        os.replace(tmp_filename, dst)
+    except BaseException:
+        Path(tmp_filename).unlink(missing_ok=True)
+        raise
+
+
 def save_json_file(data, country):
     """
     Save data to JSON file with versioning.
 
+    DATA_DIR must already exist (main creates it once per run).
+
     Args:
         data: Data dict to save
         country: Country code for filename
     """
-    Path(DATA_DIR).mkdir(exist_ok=True)
-
     # Save versioned file with timestamp
     timestamp = int(datetime.now(timezone.utc).timestamp())
     versioned_filename = f"{DATA_DIR}/{country.lower()}-{timestamp}.json"
@@ -479,13 +1146,12 @@ def save_json_file(data, country):
 
     try:
         # Save versioned file
-        with open(versioned_filename, "w") as f:
-            json.dump(data, f, indent=2)
+        write_json(versioned_filename, data)
         logger.info(f"Saved versioned data to {versioned_filename}")
 
-        # Save regular file
-        with open(regular_filename, "w") as f:
-            json.dump(data, f, indent=2)
+        # Save regular file: same contents, so link it instead of
+        # serializing and writing the payload a second time
+        link_json(versioned_filename, regular_filename)
         logger.info(f"Saved data to {regular_filename}")
 
         return versioned_filename
@@ -503,22 +1169,23 @@ def cleanup_old_versions(keep_versions=5):
     """
     logger.info(f"Cleaning up old versioned files (keeping {keep_versions} versions)...")
 
-    for country in COUNTRIES:
-        country_lower = country.lower()
-        pattern = f"{DATA_DIR}/{country_lower}-*.json"
-
-        # Find all versioned files for this country
-        versioned_files = []
-        for filepath in Path(DATA_DIR).glob(f"{country_lower}-*.json"):
-            # Extract timestamp from filename (e.g., ph-1769057744.json -> 1769057744)
-            filename = filepath.name
+    # Scan DATA_DIR once and bucket versioned files by country
+    # (e.g., ph-1769057744.json -> ("ph", 1769057744))
+    versioned_by_country = {country.lower(): [] for country in COUNTRIES}
+    with os.scandir(DATA_DIR) as entries:
+        for entry in entries:
+            prefix, sep, rest = entry.name.partition("-")
+            if not sep or prefix not in versioned_by_country or not rest.endswith(".json"):
+                continue
             try:
-                timestamp_str = filename.replace(f"{country_lower}-", "").replace(".json", "")
-                timestamp = int(timestamp_str)
-                versioned_files.append((timestamp, filepath))
+                timestamp = int(rest.removesuffix(".json"))
             except ValueError:
                 # Skip files that don't match the versioned pattern
                 continue
+            versioned_by_country[prefix].append((timestamp, entry))
+
+    for country in COUNTRIES:
+        versioned_files = versioned_by_country[country.lower()]
 
         # Sort by timestamp (newest first)
         versioned_files.sort(reverse=True, key=lambda x: x[0])
@@ -527,12 +1194,12 @@ def cleanup_old_versions(keep_versions=5):
         files_to_delete = versioned_files[keep_versions:]
 
         # Delete old versions
-        for timestamp, filepath in files_to_delete:
+        for timestamp, entry in files_to_delete:
             try:
-                filepath.unlink()
-                logger.info(f"Deleted old version: {filepath.name}")
+                os.unlink(entry.path)
+                logger.info(f"Deleted old version: {entry.name}")
             except Exception as e:
-                logger.warning(f"Failed to delete {filepath.name}: {e}")
+                logger.warning(f"Failed to delete {entry.name}: {e}")
 
         if files_to_delete:
             logger.info(f"{country} - Deleted {len(files_to_delete)} old version(s)")
@@ -540,144 +1207,251 @@ def cleanup_old_versions(keep_versions=5):
             logger.info(f"{country} - No old versions to delete")
 
 
-def main():
-    """Main execution function."""
-    logger.info("Starting data extraction...")
+def run_with_cursor(connection_factory, query_fn, *args):
+    """
+    Run query_fn(cursor, *args) on a new cursor of the calling thread's connection.
+
+    Args:
+        connection_factory: Callable returning the calling thread's Databricks connection
+        query_fn: Query function taking a cursor as its first argument
+        *args: Remaining arguments for query_fn
+
+    Returns:
+        The result of query_fn
+    """
+    with connection_factory().cursor() as cursor:
+        return query_fn(cursor, *args)
+
+
+def process_country(country, context, query_pool, connection_factory):
+    """
+    Extract, calculate and save dashboard data for a single country.
+
+    Runs in its own worker thread; the country's queries run concurrently on
+    the shared query pool, whose threads each keep their own connection.
+
+    Args:
+        country: Country code (PH or VN)
+        context: RunContext with the run's dates
+        query_pool: Executor running the queries
+        connection_factory: Callable returning the calling thread's Databricks connection
+
+    Returns:
+        Path of the versioned JSON file written for the country
+    """
+    # Calculate date ranges
+    today = context.today
+    same_day_last_week = context.same_day_last_week
+    mtd_start = context.mtd_start
+    last_month_mtd_start, last_month_mtd_end = context.last_month_mtd_start, context.last_month_mtd_end
+    history_start = today - timedelta(days=15)
+    # Raw rows are only needed for MTD and the same-time comparisons; older
+    # history days are aggregated in Databricks
+    query_start = min(mtd_start, same_day_last_week)
+
+    logger.info(f"Processing {country}...")
+
+    # Get current hour in country's timezone for same-time comparison
+    country_tz = TIMEZONES.get(country)
+    current_time = context.now.astimezone(country_tz)
+    current_hour = current_time.hour
+
+    logger.info(f"{country} - Current time: {current_time.strftime('%Y-%m-%d %H:%M:%S')} ({country_tz})")
+    logger.info(f"{country} - Using hour limit: {current_hour} for same-time comparison")
+
+    # The country's queries are independent, so run them concurrently on the
+    # query pool, each on its query thread's connection:
+    # - MTD and today in one pass - the same-time and MTD slices are all
+    #   subsets of this range and are derived below
+    # - last month MTD (same date range but one month ago)
+    # - pre-aggregated history days before the raw window
+    all_future = query_pool.submit(run_with_cursor, connection_factory, query_orders, country, query_start, today, today)
+    last_month_future = query_pool.submit(
+        run_with_cursor, connection_factory, query_orders,
+        country, last_month_mtd_start, last_month_mtd_end, today,
+    )
+    history_future = None
+    if history_start < query_start:
+        history_future = query_pool.submit(
+            run_with_cursor, connection_factory, query_daily_aggregates,
+            country, history_start, query_start - timedelta(days=1), today,
+        )
+
+    df_all_rows = all_future.result()
+    df_all = deduplicate_orders(df_all_rows)
+    df_mtd_last_month = deduplicate_orders(last_month_future.result())
+    df_history_aggregates = history_future.result() if history_future else None
+
+    logger.info(f"{country} - Last month MTD ({last_month_mtd_start} to {last_month_mtd_end}): {len(df_mtd_last_month)} orders")
+
+    if df_all.empty:
+        logger.warning(f"No data for {country}, creating empty output...")
+        # Create empty structure
+        empty_metrics = calculate_metrics(pd.DataFrame(), country)
+        data = generate_json_output(
+            country,
+            context,
+            empty_metrics,
+            empty_metrics,
+            empty_metrics,
+            empty_metrics,
+            [],
+            empty_metrics,
+            empty_metrics,
+        )
+        return save_json_file(data, country)
+
+    # Filter for different time periods using the date columns from query_orders.
+    # local_date holds midnight timestamps, so compare against Timestamps.
+    # Same-time comparisons only count orders up to the current local hour.
+    # Rows past the hour are dropped before deduplicating, so an order updated
+    # after the cutoff still counts with its latest row before it. Today and
+    # last week share one mask and are split by a single groupby
+    today_key = pd.Timestamp(today)
+    last_week_key = pd.Timestamp(same_day_last_week)
+    df_same_time = deduplicate_orders(df_all_rows[
+        (df_all_rows["local_hour"] <= current_hour)
+        & df_all_rows["local_date"].isin([today_key, last_week_key])
+    ])
+    same_time_days = dict(tuple(df_same_time.groupby("local_date")))
+    df_today_limited = same_time_days.get(today_key, df_same_time.iloc[:0])
+    df_last_week = same_time_days.get(last_week_key, df_same_time.iloc[:0])
+    df_mtd = df_all[df_all["local_date"] >= pd.Timestamp(mtd_start)]
+
+    logger.info(f"{country} - MTD ({mtd_start} to {today}): {len(df_mtd)} orders")
+    logger.info(f"{country} - Today (up to {current_hour}:00): {len(df_today_limited)} orders")
+    logger.info(f"{country} - Last week (up to {current_hour}:00): {len(df_last_week)} orders")
+
+    # Calculate metrics using hour-limited data for fair comparison
+    same_time_metrics = calculate_grouped_metrics(df_same_time, "local_date", country)
+    metrics_today = lookup_metrics(same_time_metrics, today_key, country)
+    metrics_last_week = lookup_metrics(same_time_metrics, last_week_key, country)
+    metrics_mtd = calculate_metrics(df_mtd, country)
+    metrics_mtd_last_month = calculate_metrics(df_mtd_last_month, country)
+
+    logger.info(f"{country} - MTD GMV: ${metrics_mtd['total_gmv_usd']:,.2f}, Orders: {metrics_mtd['orders']:,}")
+
+    # Calculate daily history: days inside the raw window are aggregated
+    # locally, earlier days come pre-aggregated from Databricks
+    daily_totals = aggregate_totals(df_all[df_all["local_date"] >= pd.Timestamp(history_start)], "local_date")
+    if df_history_aggregates is not None:
+        daily_totals = pd.concat([df_history_aggregates, daily_totals])
+    daily = calculate_daily_metrics(daily_totals, country)
+
+    # Replace today's entry with hour-limited data to match the boxes
+    if today_key in daily.index:
+        daily.loc[today_key, METRIC_COLUMNS] = [metrics_today[column] for column in METRIC_COLUMNS]
+        logger.info(f"{country} - Updated today's chart data to match hour-limited boxes ({metrics_today['orders']} orders)")
+
+    # Calculate moving averages
+    ma_7d, ma_15d = calculate_moving_averages(daily, (7, 15))
+
+    # Calculate channel metrics using Silver data
+    channel_metrics_today = calculate_channel_metrics(df_today_limited, country)
+
+    channel_metrics_last_week = calculate_channel_metrics(df_last_week, country)
+    channel_metrics_mtd = calculate_channel_metrics(df_mtd, country)
+    channel_metrics_mtd_last_month = calculate_channel_metrics(df_mtd_last_month, country)
+
+    # Generate and save JSON
+    data = generate_json_output(
+        country,
+        context,
+        metrics_today,
+        metrics_last_week,
+        metrics_mtd,
+        metrics_mtd_last_month,
+        daily_metrics_records(daily),
+        ma_7d,
+        ma_15d,
+        channel_metrics_today,
+        channel_metrics_last_week,
+        channel_metrics_mtd,
+        channel_metrics_mtd_last_month,
+    )
+    versioned_file = save_json_file(data, country)
+
+    logger.info(f"{country} - Today GMV: {metrics_today['total_gmv']}, Orders: {metrics_today['orders']}")
+    logger.info(f"{country} - Last week (same time) GMV: {metrics_last_week['total_gmv']}, Orders: {metrics_last_week['orders']}")
+
+    return versioned_file
+
+
+def smoke_test():
+    """
+    Check connectivity and today's order counts without writing any files.
+
+    Runs the today-range query for each country in turn, so a broken
+    connection, credential or query fails fast.
+    """
+    logger.info("Starting smoke test...")
+
+    today = RunContext.capture().today
 
     try:
-        # Connect to Databricks
-        connection = connect_to_databricks()
+        # One cursor for every country's probe query
+        with get_connection().cursor() as cursor:
+            for country in COUNTRIES:
+                df_today = deduplicate_orders(query_orders(cursor, country, today, today, today))
+                logger.info(f"{country} - Today ({today}): {len(df_today)} orders")
 
-        # Calculate date ranges
-        today = get_today()
-        same_day_last_week = get_same_day_last_week()
-        mtd_start = get_mtd_start()
-        last_month_mtd_start, last_month_mtd_end = get_last_month_mtd_range()
-        history_start = today - timedelta(days=15)
+        logger.info("Smoke test completed successfully")
 
-        # Track versioned filenames for manifest
-        manifest = {}
-
-        for country in COUNTRIES:
-            logger.info(f"Processing {country}...")
-
-            # Get current hour in country's timezone for same-time comparison
-            country_tz = TIMEZONES.get(country)
-            current_time = datetime.now(country_tz)
-            current_hour = current_time.hour
-
-            logger.info(f"{country} - Current time: {current_time.strftime('%Y-%m-%d %H:%M:%S')} ({country_tz})")
-            logger.info(f"{country} - Using hour limit: {current_hour} for same-time comparison")
-
-            # Query all data needed (last 15 days) - no hour filter
-            df_all = query_orders(connection, country, history_start, today)
-
-            # Query today's data with hour limit (up to current hour)
-            df_today_limited = query_orders(connection, country, today, today, hour_limit=current_hour)
-
-            # Query last week data with same hour limit
-            df_last_week = query_orders(connection, country, same_day_last_week, same_day_last_week, hour_limit=current_hour)
-
-            # Query last month MTD data (same date range but one month ago)
-            df_mtd_last_month = query_orders(connection, country, last_month_mtd_start, last_month_mtd_end)
-
-            # Query MTD data from Silver (full month to date)
-            df_mtd_silver = query_orders(connection, country, mtd_start, today)
-            logger.info(f"{country} - MTD Silver ({mtd_start} to {today}): {len(df_mtd_silver)} orders")
-
-            logger.info(f"{country} - Today (up to {current_hour}:00): {len(df_today_limited)} orders")
-            logger.info(f"{country} - Last week (up to {current_hour}:00): {len(df_last_week)} orders")
-            logger.info(f"{country} - Last month MTD ({last_month_mtd_start} to {last_month_mtd_end}): {len(df_mtd_last_month)} orders")
-
-            if df_all.empty:
-                logger.warning(f"No data for {country}, creating empty output...")
-                # Create empty structure
-                empty_metrics = calculate_metrics(pd.DataFrame(), country)
-                data = generate_json_output(
-                    country,
-                    empty_metrics,
-                    empty_metrics,
-                    empty_metrics,
-                    empty_metrics,
-                    [],
-                    empty_metrics,
-                    empty_metrics,
-                )
-                versioned_file = save_json_file(data, country)
-                manifest[country.lower()] = versioned_file.split('/')[-1]
-                continue
+    except Exception as e:
+        logger.error(f"Smoke test failed: {e}")
+        sys.exit(1)
 
-            # Filter for different time periods (handle mixed ISO8601 formats)
-            df_all["date"] = pd.to_datetime(df_all["placement_date"], format='mixed', utc=True).dt.date
-
-            # Use Silver MTD data directly
-            df_mtd = df_mtd_silver
-
-            # Calculate metrics using hour-limited data for fair comparison
-            metrics_today = calculate_metrics(df_today_limited, country)
-            metrics_last_week = calculate_metrics(df_last_week, country)
-            metrics_mtd = calculate_metrics(df_mtd, country)
-            metrics_mtd_last_month = calculate_metrics(df_mtd_last_month, country)
-
-            logger.info(f"{country} - MTD GMV: ${metrics_mtd['total_gmv_usd']:,.2f}, Orders: {metrics_mtd['orders']:,}")
-
-            # Calculate daily history
-            daily_metrics = calculate_daily_metrics(df_all, country)
-
-            # Replace today's entry with hour-limited data to match the boxes
-            today_str = today.strftime('%Y-%m-%d')
-            today_daily_metric = {
-                "total_gmv": metrics_today["total_gmv"],
-                "total_gmv_usd": metrics_today["total_gmv_usd"],
-                "orders": metrics_today["orders"],
-                "unique_buyers": metrics_today["unique_buyers"],
-                "unique_vendors": metrics_today["unique_vendors"],
-                "aov": metrics_today["aov"],
-                "aov_usd": metrics_today["aov_usd"],
-                "frequency": metrics_today["frequency"],
-                "gmv_per_poc": metrics_today["gmv_per_poc"],
-                "gmv_per_poc_usd": metrics_today["gmv_per_poc_usd"],
-                "date": today_str
-            }
-
-            # Find and replace today's entry in daily_metrics
-            for i, metric in enumerate(daily_metrics):
-                if metric["date"] == today_str:
-                    daily_metrics[i] = today_daily_metric
-                    logger.info(f"{country} - Updated today's chart data to match hour-limited boxes ({metrics_today['orders']} orders)")
-                    break
-
-            # Calculate moving averages
-            ma_7d = calculate_moving_average(daily_metrics, 7)
-            ma_15d = calculate_moving_average(daily_metrics, 15)
-
-            # Calculate channel metrics using Silver data
-            channel_metrics_today = calculate_channel_metrics(df_today_limited, country)
-
-            channel_metrics_last_week = calculate_channel_metrics(df_last_week, country)
-            channel_metrics_mtd = calculate_channel_metrics(df_mtd, country)
-            channel_metrics_mtd_last_month = calculate_channel_metrics(df_mtd_last_month, country)
-
-            # Generate and save JSON
-            data = generate_json_output(
-                country,
-                metrics_today,
-                metrics_last_week,
-                metrics_mtd,
-                metrics_mtd_last_month,
-                daily_metrics,
-                ma_7d,
-                ma_15d,
-                channel_metrics_today,
-                channel_metrics_last_week,
-                channel_metrics_mtd,
-                channel_metrics_mtd_last_month,
-            )
-            versioned_file = save_json_file(data, country)
-            manifest[country.lower()] = versioned_file.split('/')[-1]
 
-            logger.info(f"{country} - Today GMV: {metrics_today['total_gmv']}, Orders: {metrics_today['orders']}")
-            logger.info(f"{country} - Last week (same time) GMV: {metrics_last_week['total_gmv']}, Orders: {metrics_last_week['orders']}")
+def main(mode="full"):
+    """
+    Main execution function.
+
+    Args:
+        mode: "full" runs the extraction and writes the dashboard JSON;
+            "smoke" only runs smoke_test
+    """
+    if mode == "smoke":
+        smoke_test()
+        return
+
+    logger.info("Starting data extraction...")
+
+    # Snapshot the run's dates once for all countries
+    context = RunContext.capture()
+
+    try:
+        # Create the output directory once, before any country writes to it
+        Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
+
+        # Countries are independent and IO-bound on Databricks, so extract them
+        # concurrently; their queries share one fixed pool of query threads,
+        # each reusing its own connection
+        versioned_files = {}
+        try:
+            with (
+                ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="query") as query_pool,
+                ThreadPoolExecutor(max_workers=len(COUNTRIES), thread_name_prefix="extract") as executor,
+            ):
+                futures = {
+                    executor.submit(process_country, country, context, query_pool, get_connection): country
+                    for country in COUNTRIES
+                }
+                for future in as_completed(futures):
+                    country = futures[future]
+                    try:
+                        versioned_files[country] = future.result()
+                    except Exception:
+                        logger.error(f"{country} - Extraction failed")
+                        raise
+        finally:
+            # The query threads are done; don't hold their sessions until exit
+            close_connections()
+
+        # Track versioned filenames for manifest
+        manifest = {
+            country.lower(): versioned_files[country].split('/')[-1]
+            for country in COUNTRIES
+        }
 
         # Save manifest with versioned filenames
         manifest_file = f"{DATA_DIR}/data-manifest.json"
@@ -685,14 +1459,12 @@ def main():
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "files": manifest
         }
-        with open(manifest_file, "w") as f:
-            json.dump(manifest_data, f, indent=2)
+        write_json(manifest_file, manifest_data)
         logger.info(f"Saved manifest to {manifest_file}")
 
         # Clean up old versioned files
         cleanup_old_versions(keep_versions=5)
 
-        connection.close()
         logger.info("Data extraction completed successfully")
 
     except Exception as e:
@@ -701,4 +1473,14 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--mode",
+        choices=["full", "smoke"],
+        default="full",
+        help="full: extract and write dashboard data (default); smoke: only query today's orders",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    main(args.mode)